@@ -5,13 +5,12 @@ import cv2
 import numpy as np
 from streamlit_webrtc import webrtc_streamer, VideoProcessorBase, RTCConfiguration, WebRtcMode
 import av
+import os
 import threading
-import pyttsx3
-import queue
 import time
-import pandas as pd
 import altair as alt
-from utils import PoseAnalyzer, get_pose_landmarks_info
+from concurrent.futures import ThreadPoolExecutor
+from utils import PoseAnalyzer, get_pose_landmarks_info, load_workout_history, start_tts_loop, WORKOUT_HISTORY_CSV
 from firebase_helper import save_workout_to_firebase, get_all_workouts
 
 # ----------------- Streamlit Page Config -----------------
@@ -28,77 +27,186 @@ def initialize_state():
         st.session_state.pose_analyzer = PoseAnalyzer()
     if 'voice_enabled' not in st.session_state:
         st.session_state.voice_enabled = False
-    if 'last_feedback' not in st.session_state:
-        st.session_state.last_feedback = ""
-    if 'feedback_queue' not in st.session_state:
-        st.session_state.feedback_queue = queue.Queue()
     if 'frame_count' not in st.session_state:
         st.session_state.frame_count = 0
-    if 'tts_thread' not in st.session_state:
-        st.session_state.tts_thread = None
+    if 'speak_feedback' not in st.session_state:
+        st.session_state.speak_feedback = None
     if 'pose_detected' not in st.session_state:
         st.session_state.pose_detected = False
+    if 'cloud_save' not in st.session_state:
+        st.session_state.cloud_save = None
+    if 'cloud_history' not in st.session_state:
+        st.session_state.cloud_history = None
+    if 'cloud_synced_at' not in st.session_state:
+        st.session_state.cloud_synced_at = 0.0
 
 initialize_state()
 
+# ----------------- Cloud Sync -----------------
+@st.cache_resource
+def get_firebase_executor():
+    # Single worker so Firestore writes stay ordered and off the UI thread
+    return ThreadPoolExecutor(max_workers=1)
+
+def finish_cloud_save(wait=False):
+    """Collect the background Firebase save, warning if it failed"""
+    future = st.session_state.cloud_save
+    if future is None or not (wait or future.done()):
+        return
+    try:
+        future.result()
+    except Exception:
+        st.warning("⚠️ Last workout could not be synced to cloud.")
+    finally:
+        st.session_state.cloud_save = None
+
+CLOUD_HISTORY_TTL = 60  # seconds before cloud history is refetched
+
+def load_cloud_history():
+    """Fetch cloud workouts, reusing the last fetch for CLOUD_HISTORY_TTL seconds"""
+    if (st.session_state.cloud_history is None or
+            time.time() - st.session_state.cloud_synced_at > CLOUD_HISTORY_TTL):
+        finish_cloud_save(wait=True)  # Include the pending write
+        st.session_state.cloud_history = get_all_workouts()
+        st.session_state.cloud_synced_at = time.time()
+    return st.session_state.cloud_history
+
+# ----------------- Workout History -----------------
+# Keyed by the CSV mtime so reruns skip parsing and chart building until a save
+@st.cache_data(ttl=30)
+def load_history(path, mtime):
+    return load_workout_history(path)
+
+# Chart objects are reused as-is rather than pickled and copied on every hit
+@st.cache_resource(ttl=30)
+def build_history_charts(path, mtime):
+    df = load_history(path, mtime)
+
+    reps_chart = alt.Chart(df).mark_line(point=True).encode(
+        x='date:T',
+        y='reps:Q',
+        tooltip=['date', 'reps']
+    ).properties(title="📈 Reps Over Time")
+
+    accuracy_chart = alt.Chart(df).mark_line(point=True, color="green").encode(
+        x='date:T',
+        y='accuracy:Q',
+        tooltip=['date', 'accuracy']
+    ).properties(title="🎯 Accuracy Over Time")
+
+    return reps_chart, accuracy_chart
+
 # ----------------- VideoProcessor Class -----------------
 class VideoProcessor(VideoProcessorBase):
-    def __init__(self):
-        initialize_state()
-        self.pose_analyzer = st.session_state.pose_analyzer
+    def __init__(self, pose_analyzer):
+        # Built by streamlit-webrtc off the script thread, where st.session_state
+        # is not the user's session, so the analyzer is passed in
+        self.pose_analyzer = pose_analyzer
         self.activity_mode = "Free Pose"
+        self.voice_enabled = False
+        self.speak_feedback = None
         self.frame_count = 0
-        self.skip_frames = 2
+        self.skip_frames = 1  # Knee angle is smoothed in PoseAnalyzer, so analyse every frame
+        self._last_feedback = ""
+
+        # Stats shared with the UI thread; recv never touches st.session_state
+        self._shared = {'pose_detected': False, 'frame_count': 0, 'squat_data': None}
+        self._shared_lock = threading.Lock()
 
     def recv(self, frame: av.VideoFrame) -> av.VideoFrame:
         try:
-            img = frame.to_ndarray(format="bgr24")
+            # Pass skipped frames straight through (keeps PTS, no ndarray copies)
             self.frame_count += 1
             if self.frame_count % self.skip_frames != 0:
-                return av.VideoFrame.from_ndarray(img, format="bgr24")
+                return frame
 
+            img = frame.to_ndarray(format="bgr24")
             processed_frame, pose_data = self.pose_analyzer.process_frame(img, self.activity_mode)
 
-            if pose_data['landmarks_detected']:
-                st.session_state.pose_detected = True
-                st.session_state.frame_count += 1
-
-                if pose_data['squat_data']:
-                    st.session_state.squat_data = pose_data['squat_data']
-                    if (
-                        st.session_state.voice_enabled and
-                        pose_data['squat_data']['feedback'] != st.session_state.last_feedback and
-                        self.frame_count % 30 == 0
-                    ):
-                        try:
-                            st.session_state.feedback_queue.put_nowait(pose_data['squat_data']['feedback'])
-                            st.session_state.last_feedback = pose_data['squat_data']['feedback']
-                        except queue.Full:
-                            pass
-            else:
-                st.session_state.pose_detected = False
+            squat_data = pose_data['squat_data']
+            with self._shared_lock:
+                self._shared['pose_detected'] = pose_data['landmarks_detected']
+                if pose_data['landmarks_detected']:
+                    self._shared['frame_count'] += 1
+                    if squat_data:
+                        self._shared['squat_data'] = squat_data
+
+            if (
+                squat_data and
+                self.voice_enabled and
+                self.speak_feedback and
+                squat_data['feedback'] != self._last_feedback and
+                self.frame_count % 30 == 0
+            ):
+                self.speak_feedback(squat_data['feedback'])
+                self._last_feedback = squat_data['feedback']
+
+            # Without landmarks nothing was drawn; if the frame was not downscaled
+            # either, pass the incoming frame through instead of copying it. A
+            # downscaled frame is still sent so the output size stays constant.
+            if not pose_data['landmarks_detected'] and processed_frame.shape == img.shape:
+                return frame
 
             return av.VideoFrame.from_ndarray(processed_frame, format="bgr24")
         except Exception:
             return frame
 
-# ----------------- Text-to-Speech -----------------
-def text_to_speech_worker():
+    def get_snapshot(self):
+        """Copy of the latest pose stats, safe to read from the UI thread"""
+        with self._shared_lock:
+            return dict(self._shared)
+
+def sync_processor_state(video_processor):
+    """Copy the video processor's stats into session state from the script thread"""
+    snapshot = video_processor.get_snapshot()
+    st.session_state.pose_detected = snapshot['pose_detected']
+    st.session_state.frame_count = snapshot['frame_count']
+    if snapshot['squat_data']:
+        st.session_state.squat_data = snapshot['squat_data']
+
+# ----------------- Live Panels -----------------
+# Fragments rerun on their own, so live stats refresh at 2 Hz without
+# rerunning the whole script (video component, charts, settings)
+@st.fragment(run_every=0.5)
+def workout_stats_panel(webrtc_ctx):
+    if webrtc_ctx.video_processor:
+        sync_processor_state(webrtc_ctx.video_processor)
+
+    st.header("📊 Workout Stats")
+    if hasattr(st.session_state, 'squat_data'):
+        squat_data = st.session_state.squat_data
+        st.metric("Repetitions", squat_data['count'])
+        stage_color = "🟢" if squat_data['stage'] == "up" else "🔴"
+        st.metric("Current Stage", f"{stage_color} {squat_data['stage'].upper()}")
+        st.metric("Knee Angle", f"{squat_data['angle']}°")
+        accuracy = squat_data['accuracy']
+        st.metric("Form Accuracy", f"{accuracy}%")
+        st.progress(accuracy / 100)
+        st.info(f"💬 {squat_data['feedback']}")
+    else:
+        st.info("Start exercising to see stats!")
+
+@st.fragment(run_every=0.5)
+def diagnostics_panel(webrtc_ctx):
+    if webrtc_ctx.video_processor:
+        sync_processor_state(webrtc_ctx.video_processor)
+
+    st.header("🔍 Diagnostics")
+    st.metric("Frames Processed", st.session_state.frame_count)
+    st.success("✅ Pose Detected" if st.session_state.pose_detected else "⚠️ No Pose Detected")
+
+def workout_progress_panel():
     try:
-        engine = pyttsx3.init()
-        engine.setProperty('rate', 150)
-        engine.setProperty('volume', 0.8)
-        while True:
-            try:
-                feedback = st.session_state.feedback_queue.get(timeout=1)
-                if feedback and st.session_state.voice_enabled:
-                    clean_feedback = ''.join(char for char in feedback if char.isalnum() or char.isspace())
-                    engine.say(clean_feedback)
-                    engine.runAndWait()
-            except queue.Empty:
-                continue
+        history_mtime = os.path.getmtime(WORKOUT_HISTORY_CSV)
+        df = load_history(WORKOUT_HISTORY_CSV, history_mtime)
+        if not df.empty:
+            st.subheader("📊 Workout Progress")
+
+            reps_chart, accuracy_chart = build_history_charts(WORKOUT_HISTORY_CSV, history_mtime)
+            st.altair_chart(reps_chart, use_container_width=True)
+            st.altair_chart(accuracy_chart, use_container_width=True)
     except Exception as e:
-        print(f"TTS initialization failed: {e}")
+        st.warning("⚠️ Could not load workout history.")
 
 # ----------------- Main UI -----------------
 def main():
@@ -112,84 +220,6 @@ def main():
         quality_mode = st.selectbox("Video Quality:", ["Low (Better Performance)", "Medium", "High (May Lag)"], index=0)
         st.divider()
 
-        if activity_mode == "Squat Counter":
-            st.header("📊 Workout Stats")
-            if hasattr(st.session_state, 'squat_data'):
-                squat_data = st.session_state.squat_data
-                st.metric("Repetitions", squat_data['count'])
-                stage_color = "🟢" if squat_data['stage'] == "up" else "🔴"
-                st.metric("Current Stage", f"{stage_color} {squat_data['stage'].upper()}")
-                st.metric("Knee Angle", f"{squat_data['angle']}°")
-                accuracy = squat_data['accuracy']
-                st.metric("Form Accuracy", f"{accuracy}%")
-                st.progress(accuracy / 100)
-                st.info(f"💬 {squat_data['feedback']}")
-            else:
-                st.info("Start exercising to see stats!")
-
-            if st.button("🔄 Reset Counter", type="secondary"):
-                st.session_state.pose_analyzer.reset_counter()
-                st.rerun()
-
-            if hasattr(st.session_state, 'squat_data') and st.session_state.squat_data['count'] > 0:
-                if st.button("📂 Save Workout", type="primary"):
-                    st.session_state.pose_analyzer.save_workout_data(
-                        st.session_state.squat_data['count'],
-                        st.session_state.squat_data['accuracy']
-                    )
-                    save_workout_to_firebase(
-                        reps=st.session_state.squat_data['count'],
-                        accuracy=st.session_state.squat_data['accuracy']
-                    )
-                    st.success("✅ Workout saved locally and to cloud!")
-
-                try:
-                    with open("workout_history.csv", "rb") as file:
-                        st.download_button(
-                            label="📥 Download Workout History (CSV)",
-                            data=file,
-                            file_name="workout_history.csv",
-                            mime="text/csv"
-                        )
-                except FileNotFoundError:
-                    st.warning("No workout history available yet.")
-
-                try:
-                    df = pd.read_csv("workout_history.csv")
-                    if not df.empty:
-                        st.subheader("📊 Workout Progress")
-
-                        reps_chart = alt.Chart(df).mark_line(point=True).encode(
-                            x='date:T',
-                            y='reps:Q',
-                            tooltip=['date', 'reps']
-                        ).properties(title="📈 Reps Over Time")
-
-                        accuracy_chart = alt.Chart(df).mark_line(point=True, color="green").encode(
-                            x='date:T',
-                            y='accuracy:Q',
-                            tooltip=['date', 'accuracy']
-                        ).properties(title="🎯 Accuracy Over Time")
-
-                        st.altair_chart(reps_chart, use_container_width=True)
-                        st.altair_chart(accuracy_chart, use_container_width=True)
-                except Exception as e:
-                    st.warning("⚠️ Could not load workout history.")
-
-                # ☁️ Show Firebase (Cloud) History
-                if st.toggle("🌐 Show Cloud History"):
-                    try:
-                        df_cloud = get_all_workouts()
-                        st.dataframe(df_cloud)
-                        st.success("✅ Synced with Firebase")
-                    except Exception as e:
-                        st.error("❌ Could not load Firebase data")
-
-        st.divider()
-        st.header("🔍 Diagnostics")
-        st.metric("Frames Processed", st.session_state.frame_count)
-        st.success("✅ Pose Detected" if st.session_state.pose_detected else "⚠️ No Pose Detected")
-
     col1, col2 = st.columns([3, 1])
     with col1:
         st.subheader("📹 Live Camera Feed")
@@ -204,10 +234,11 @@ def main():
             ]
         })
 
+        pose_analyzer = st.session_state.pose_analyzer
         webrtc_ctx = webrtc_streamer(
             key="pose-detection",
             mode=WebRtcMode.SENDRECV,
-            video_processor_factory=VideoProcessor,
+            video_processor_factory=lambda: VideoProcessor(pose_analyzer),
             rtc_configuration=RTC_CONFIGURATION,
             media_stream_constraints={"video": video_constraints, "audio": False},
             async_processing=True
@@ -230,11 +261,68 @@ def main():
         if st.button("🔄 Restart Camera", type="primary"):
             st.rerun()
 
+    # Pass settings to the running processor and pull its latest stats
+    if webrtc_ctx.video_processor:
+        webrtc_ctx.video_processor.activity_mode = activity_mode
+        webrtc_ctx.video_processor.voice_enabled = st.session_state.voice_enabled
+        webrtc_ctx.video_processor.speak_feedback = st.session_state.speak_feedback
+        sync_processor_state(webrtc_ctx.video_processor)
+
+    with st.sidebar:
+        if activity_mode == "Squat Counter":
+            workout_stats_panel(webrtc_ctx)
+
+            if st.button("🔄 Reset Counter", type="secondary"):
+                st.session_state.pose_analyzer.reset()
+                st.rerun()
+
+            finish_cloud_save()
+
+            if hasattr(st.session_state, 'squat_data') and st.session_state.squat_data['count'] > 0:
+                if st.button("📂 Save Workout", type="primary"):
+                    st.session_state.pose_analyzer.save_workout_data(
+                        st.session_state.squat_data['count'],
+                        st.session_state.squat_data['accuracy']
+                    )
+                    st.session_state.cloud_save = get_firebase_executor().submit(
+                        save_workout_to_firebase,
+                        reps=st.session_state.squat_data['count'],
+                        accuracy=st.session_state.squat_data['accuracy']
+                    )
+                    st.session_state.cloud_history = None
+                    st.success("✅ Workout saved locally and queued for cloud sync!")
+
+                try:
+                    with open(WORKOUT_HISTORY_CSV, "rb") as file:
+                        st.download_button(
+                            label="📥 Download Workout History (CSV)",
+                            data=file,
+                            file_name=WORKOUT_HISTORY_CSV,
+                            mime="text/csv"
+                        )
+                except FileNotFoundError:
+                    st.warning("No workout history available yet.")
+
+                workout_progress_panel()
+
+                # ☁️ Show Firebase (Cloud) History
+                if st.toggle("🌐 Show Cloud History"):
+                    if st.button("🔄 Refresh Cloud History"):
+                        st.session_state.cloud_history = None
+                    try:
+                        df_cloud = load_cloud_history()
+                        st.dataframe(df_cloud)
+                        synced_at = time.strftime("%H:%M:%S", time.localtime(st.session_state.cloud_synced_at))
+                        st.success(f"✅ Synced with Firebase at {synced_at}")
+                    except Exception as e:
+                        st.error("❌ Could not load Firebase data")
+
+        st.divider()
+        diagnostics_panel(webrtc_ctx)
+
 # ----------------- Launch Background TTS -----------------
-if st.session_state.voice_enabled and st.session_state.feedback_queue:
-    if not st.session_state.tts_thread or not st.session_state.tts_thread.is_alive():
-        st.session_state.tts_thread = threading.Thread(target=text_to_speech_worker, daemon=True)
-        st.session_state.tts_thread.start()
+if st.session_state.voice_enabled and st.session_state.speak_feedback is None:
+    st.session_state.speak_feedback = start_tts_loop()
 
 if __name__ == "__main__":
     main()
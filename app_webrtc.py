@@ -6,10 +6,8 @@ import numpy as np
 from streamlit_webrtc import webrtc_streamer, VideoProcessorBase, RTCConfiguration, WebRtcMode
 import av
 import threading
-import pyttsx3
-import queue
 import time
-from utils import PoseAnalyzer
+from utils import PoseAnalyzer, start_tts_loop
 
 # ----------------- Streamlit Page Config -----------------
 st.set_page_config(
@@ -25,77 +23,96 @@ def initialize_state():
         st.session_state.pose_analyzer = PoseAnalyzer()
     if 'voice_enabled' not in st.session_state:
         st.session_state.voice_enabled = False
-    if 'last_feedback' not in st.session_state:
-        st.session_state.last_feedback = ""
-    if 'feedback_queue' not in st.session_state:
-        st.session_state.feedback_queue = queue.Queue()
     if 'frame_count' not in st.session_state:
         st.session_state.frame_count = 0
     if 'pose_detected' not in st.session_state:
         st.session_state.pose_detected = False
-    if 'tts_thread' not in st.session_state:
-        st.session_state.tts_thread = None
+    if 'speak_feedback' not in st.session_state:
+        st.session_state.speak_feedback = None
 
 initialize_state()
 
 # ----------------- Video Processor -----------------
 class VideoProcessor(VideoProcessorBase):
-    def __init__(self):
-        initialize_state()
-        self.pose_analyzer = st.session_state.pose_analyzer
+    def __init__(self, pose_analyzer):
+        # Built by streamlit-webrtc off the script thread, where st.session_state
+        # is not the user's session, so the analyzer is passed in
+        self.pose_analyzer = pose_analyzer
         self.activity_mode = "Free Pose"
+        self.voice_enabled = False
+        self.speak_feedback = None
         self.frame_count = 0
-        self.skip_frames = 2
+        self.skip_frames = 1  # Knee angle is smoothed in PoseAnalyzer, so analyse every frame
+        self._last_feedback = ""
+
+        # Stats shared with the UI thread; recv never touches st.session_state
+        self._shared = {'pose_detected': False, 'frame_count': 0, 'squat_data': None}
+        self._shared_lock = threading.Lock()
 
     def recv(self, frame: av.VideoFrame) -> av.VideoFrame:
         try:
-            img = frame.to_ndarray(format="bgr24")
+            # Pass skipped frames straight through (keeps PTS, no ndarray copies)
             self.frame_count += 1
             if self.frame_count % self.skip_frames != 0:
-                return av.VideoFrame.from_ndarray(img, format="bgr24")
+                return frame
 
+            img = frame.to_ndarray(format="bgr24")
             processed_frame, pose_data = self.pose_analyzer.process_frame(img, self.activity_mode)
 
-            if pose_data['landmarks_detected']:
-                st.session_state.pose_detected = True
-                st.session_state.frame_count += 1
-
-                if pose_data['squat_data']:
-                    st.session_state.squat_data = pose_data['squat_data']
-                    if (
-                        st.session_state.voice_enabled and
-                        pose_data['squat_data']['feedback'] != st.session_state.last_feedback and
-                        self.frame_count % 30 == 0
-                    ):
-                        try:
-                            st.session_state.feedback_queue.put_nowait(pose_data['squat_data']['feedback'])
-                            st.session_state.last_feedback = pose_data['squat_data']['feedback']
-                        except queue.Full:
-                            pass
-            else:
-                st.session_state.pose_detected = False
+            squat_data = pose_data['squat_data']
+            with self._shared_lock:
+                self._shared['pose_detected'] = pose_data['landmarks_detected']
+                if pose_data['landmarks_detected']:
+                    self._shared['frame_count'] += 1
+                    if squat_data:
+                        self._shared['squat_data'] = squat_data
+
+            if (
+                squat_data and
+                self.voice_enabled and
+                self.speak_feedback and
+                squat_data['feedback'] != self._last_feedback and
+                self.frame_count % 30 == 0
+            ):
+                self.speak_feedback(squat_data['feedback'])
+                self._last_feedback = squat_data['feedback']
+
+            # Without landmarks nothing was drawn; if the frame was not downscaled
+            # either, pass the incoming frame through instead of copying it. A
+            # downscaled frame is still sent so the output size stays constant.
+            if not pose_data['landmarks_detected'] and processed_frame.shape == img.shape:
+                return frame
 
             return av.VideoFrame.from_ndarray(processed_frame, format="bgr24")
         except Exception:
             return frame
 
-# ----------------- Text-to-Speech -----------------
-def text_to_speech_worker():
-    try:
-        engine = pyttsx3.init()
-        engine.setProperty('rate', 150)
-        engine.setProperty('volume', 0.8)
-        while True:
-            try:
-                feedback = st.session_state.feedback_queue.get(timeout=1)
-                if feedback and st.session_state.voice_enabled:
-                    clean_feedback = ''.join(char for char in feedback if char.isalnum() or char.isspace())
-                    engine.say(clean_feedback)
-                    engine.runAndWait()
-            except queue.Empty:
-                continue
-    except Exception as e:
-        print(f"TTS initialization failed: {e}")
+    def get_snapshot(self):
+        """Copy of the latest pose stats, safe to read from the UI thread"""
+        with self._shared_lock:
+            return dict(self._shared)
+
+def sync_processor_state(video_processor):
+    """Copy the video processor's stats into session state from the script thread"""
+    snapshot = video_processor.get_snapshot()
+    st.session_state.pose_detected = snapshot['pose_detected']
+    st.session_state.frame_count = snapshot['frame_count']
+    if snapshot['squat_data']:
+        st.session_state.squat_data = snapshot['squat_data']
+
+# ----------------- Live Stats -----------------
+# Reruns on its own at 2 Hz instead of rerunning the whole script
+@st.fragment(run_every=0.5)
+def workout_stats_panel(webrtc_ctx):
+    if webrtc_ctx.video_processor:
+        sync_processor_state(webrtc_ctx.video_processor)
+
+    if hasattr(st.session_state, 'squat_data'):
+        st.header("📊 Workout Stats")
+        squat_data = st.session_state.squat_data
+        st.metric("Repetitions", squat_data['count'])
+        st.metric("Current Stage", squat_data['stage'].upper())
+        st.metric("Knee Angle", f"{squat_data['angle']}°")
 
 # ----------------- Main Function -----------------
 def main():
@@ -121,15 +138,13 @@ def main():
         ]
     })
 
-    video_processor = VideoProcessor()
-    video_processor.activity_mode = activity_mode
-
     st.subheader("📹 Live Camera Feed")
 
+    pose_analyzer = st.session_state.pose_analyzer
     webrtc_ctx = webrtc_streamer(
         key="pose-webrtc",
         mode=WebRtcMode.SENDRECV,
-        video_processor_factory=lambda: video_processor,
+        video_processor_factory=lambda: VideoProcessor(pose_analyzer),
         rtc_configuration=RTC_CONFIGURATION,
         media_stream_constraints={"video": video_constraints, "audio": False},
         async_processing=True
@@ -142,11 +157,20 @@ def main():
     else:
         st.error("🔴 Disconnected")
 
-# ----------------- Launch TTS Background Thread -----------------
-if st.session_state.voice_enabled and st.session_state.feedback_queue:
-    if not st.session_state.tts_thread or not st.session_state.tts_thread.is_alive():
-        st.session_state.tts_thread = threading.Thread(target=text_to_speech_worker, daemon=True)
-        st.session_state.tts_thread.start()
+    # Pass settings to the running processor and pull its latest stats
+    if webrtc_ctx.video_processor:
+        webrtc_ctx.video_processor.activity_mode = activity_mode
+        webrtc_ctx.video_processor.voice_enabled = st.session_state.voice_enabled
+        webrtc_ctx.video_processor.speak_feedback = st.session_state.speak_feedback
+        sync_processor_state(webrtc_ctx.video_processor)
+
+    if activity_mode == "Squat Counter":
+        with st.sidebar:
+            workout_stats_panel(webrtc_ctx)
+
+# ----------------- Launch Background TTS -----------------
+if st.session_state.voice_enabled and st.session_state.speak_feedback is None:
+    st.session_state.speak_feedback = start_tts_loop()
 
 if __name__ == "__main__":
     main()
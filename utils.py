@@ -1,9 +1,133 @@
 import numpy as np
 import cv2
 import mediapipe as mp
+import asyncio
 import math
+import os
+import queue
+import threading
+import time
 import pandas as pd
+import pyttsx3
 from datetime import datetime
+from mediapipe.framework.formats import landmark_pb2
+
+# MediaPipe Tasks pose model (download from the MediaPipe model page)
+POSE_LANDMARKER_MODEL = "pose_landmarker_lite.task"
+
+# Workout history storage
+WORKOUT_HISTORY_CSV = "workout_history.csv"
+WORKOUT_HISTORY_CACHE = "workout_history.pkl"
+
+# Landmark indices used for squat analysis (resolved once instead of per frame)
+_LHIP = mp.solutions.pose.PoseLandmark.LEFT_HIP.value
+_LKNEE = mp.solutions.pose.PoseLandmark.LEFT_KNEE.value
+_LANKLE = mp.solutions.pose.PoseLandmark.LEFT_ANKLE.value
+_RHIP = mp.solutions.pose.PoseLandmark.RIGHT_HIP.value
+_RKNEE = mp.solutions.pose.PoseLandmark.RIGHT_KNEE.value
+_RANKLE = mp.solutions.pose.PoseLandmark.RIGHT_ANKLE.value
+
+# Minimum visibility score for a landmark to be trusted in squat analysis
+MIN_LANDMARK_VISIBILITY = 0.6
+
+def create_pose_landmarker(model_path=POSE_LANDMARKER_MODEL, use_gpu=True):
+    """
+    Create a MediaPipe Tasks PoseLandmarker in VIDEO mode
+    
+    VIDEO mode tracks the pose across frames and only re-runs the person
+    detector when tracking is lost. Inference runs on the GPU delegate when
+    one is available, otherwise on the CPU (XNNPack).
+    
+    Returns:
+        PoseLandmarker, or None if the Tasks API or a loadable model file
+        is unavailable
+    """
+    if not os.path.exists(model_path):
+        return None
+    try:
+        from mediapipe.tasks.python import BaseOptions
+        from mediapipe.tasks.python import vision
+    except ImportError:
+        return None
+    
+    def build(delegate):
+        options = vision.PoseLandmarkerOptions(
+            base_options=BaseOptions(model_asset_path=model_path, delegate=delegate),
+            running_mode=vision.RunningMode.VIDEO,
+            num_poses=1,
+            min_pose_detection_confidence=0.7,
+            min_tracking_confidence=0.5
+        )
+        return vision.PoseLandmarker.create_from_options(options)
+    
+    if use_gpu:
+        try:
+            return build(BaseOptions.Delegate.GPU)
+        except Exception as e:
+            print(f"GPU delegate unavailable, using CPU: {e}")
+    try:
+        return build(BaseOptions.Delegate.CPU)
+    except Exception as e:
+        # e.g. a truncated or corrupt .task file
+        print(f"Could not load {model_path}, using legacy Pose: {e}")
+        return None
+
+class OneEuroFilter:
+    """
+    One Euro low-pass filter for noisy real-time signals
+    
+    Smooths heavily while the signal moves slowly and raises the cutoff as
+    it speeds up, so jitter is removed without lagging real movement.
+    """
+    
+    def __init__(self, min_cutoff=1.0, beta=0.007, d_cutoff=1.0, freq=30):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.freq = freq  # Fallback rate when no usable timestamp is given
+        self.reset()
+    
+    @staticmethod
+    def _alpha(cutoff, dt):
+        tau = 1.0 / (2 * math.pi * cutoff)
+        return 1.0 / (1.0 + tau / dt)
+    
+    def reset(self):
+        """Forget the filter history"""
+        self._x_prev = None
+        self._dx_prev = 0.0
+        self._t_prev = None
+    
+    def __call__(self, x, t=None):
+        """
+        Filter one sample
+        
+        Args:
+            x: New sample value
+            t: Sample time in seconds (e.g. time.monotonic())
+            
+        Returns:
+            float: Smoothed value
+        """
+        if self._x_prev is None:
+            self._x_prev, self._t_prev = x, t
+            return x
+        
+        if t is not None and self._t_prev is not None and t > self._t_prev:
+            dt = t - self._t_prev
+        else:
+            dt = 1.0 / self.freq
+        self._t_prev = t
+        
+        # Smoothed derivative drives the adaptive cutoff
+        a_d = self._alpha(self.d_cutoff, dt)
+        dx_hat = a_d * (x - self._x_prev) / dt + (1 - a_d) * self._dx_prev
+        
+        a = self._alpha(self.min_cutoff + self.beta * abs(dx_hat), dt)
+        x_hat = a * x + (1 - a) * self._x_prev
+        
+        self._x_prev, self._dx_prev = x_hat, dx_hat
+        return x_hat
 
 class PoseAnalyzer:
     """
@@ -11,16 +135,25 @@ class PoseAnalyzer:
     """
     
     def __init__(self):
-        # Initialize MediaPipe pose detection with optimized settings
+        # Initialize MediaPipe pose detection with optimized settings.
+        # Prefer the Tasks PoseLandmarker; fall back to the legacy Solutions API
         self.mp_pose = mp.solutions.pose
-        self.pose = self.mp_pose.Pose(
-            static_image_mode=False,
-            model_complexity=0,  # Reduced from 1 to 0 for better performance
-            enable_segmentation=False,
-            min_detection_confidence=0.7,  # Increased for more stable detection
-            min_tracking_confidence=0.5
-        )
+        # Each analyzer (one per session) owns its model, since both APIs
+        # keep per-stream tracking state between frames
+        self.landmarker = create_pose_landmarker()
+        self.pose = None
+        if self.landmarker is None:
+            self.pose = self.mp_pose.Pose(
+                static_image_mode=False,
+                model_complexity=0,  # Reduced from 1 to 0 for better performance
+                enable_segmentation=False,
+                min_detection_confidence=0.7,  # Increased for more stable detection
+                min_tracking_confidence=0.5
+            )
         self.mp_drawing = mp.solutions.drawing_utils
+        self._last_timestamp_ms = -1
+        self._landmark_spec = self.mp_drawing.DrawingSpec(color=(0, 255, 0), thickness=2, circle_radius=2)
+        self._conn_spec = self.mp_drawing.DrawingSpec(color=(0, 0, 255), thickness=2)
         
         # Squat tracking variables
         self.squat_stage = "up"  # "up" or "down"
@@ -30,37 +163,66 @@ class PoseAnalyzer:
         self.accuracy_score = 0
         self.frame_skip_counter = 0
         
+        # Reusable frame buffers (allocated lazily once the input size is known)
+        self._resize_buf = None
+        self._rgb_buf = None
+        
+        # Smooths the knee angle so thresholds don't trip on landmark jitter
+        self._euro = OneEuroFilter(min_cutoff=1.0, beta=0.007, freq=30)
+        
+    def find_pose(self, rgb_frame):
+        """
+        Run pose inference on an RGB frame
+        
+        Args:
+            rgb_frame: RGB image array
+            
+        Returns:
+            NormalizedLandmarkList with 33 landmarks, or None if no pose found
+        """
+        if self.landmarker is None:
+            return self.pose.process(rgb_frame).pose_landmarks
+        
+        # VIDEO mode requires strictly increasing timestamps
+        timestamp_ms = max(int(time.monotonic() * 1000), self._last_timestamp_ms + 1)
+        self._last_timestamp_ms = timestamp_ms
+        
+        mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=rgb_frame)
+        result = self.landmarker.detect_for_video(mp_image, timestamp_ms)
+        
+        if not result.pose_landmarks:
+            return None
+        
+        # Adapt to the Solutions landmark proto used by drawing and detect_squat
+        pose_landmarks = landmark_pb2.NormalizedLandmarkList()
+        pose_landmarks.landmark.extend([
+            landmark_pb2.NormalizedLandmark(
+                x=lm.x, y=lm.y, z=lm.z, visibility=lm.visibility or 0.0
+            )
+            for lm in result.pose_landmarks[0]
+        ])
+        return pose_landmarks
+    
     def calculate_angle(self, point1, point2, point3):
         """
-        Calculate angle between three points using cosine rule
+        Calculate angle between three points using atan2
         
         Args:
-            point1, point2, point3: Landmark points [x, y]
+            point1, point2, point3: Landmark points (x, y)
             
         Returns:
             angle: Angle in degrees
         """
         try:
-            # Convert to numpy arrays
-            a = np.array(point1)  # First point
-            b = np.array(point2)  # Middle point (vertex)
-            c = np.array(point3)  # Third point
-            
-            # Calculate vectors
-            ba = a - b
-            bc = c - b
+            # Angle of each arm around the middle point (vertex)
+            angle = math.degrees(
+                math.atan2(point3[1] - point2[1], point3[0] - point2[0]) -
+                math.atan2(point1[1] - point2[1], point1[0] - point2[0])
+            )
+            angle = abs(angle)
             
-            # Calculate angle using dot product
-            cosine_angle = np.dot(ba, bc) / (np.linalg.norm(ba) * np.linalg.norm(bc))
-            
-            # Ensure cosine is within valid range [-1, 1]
-            cosine_angle = np.clip(cosine_angle, -1.0, 1.0)
-            
-            # Convert to degrees
-            angle = np.arccos(cosine_angle)
-            angle_degrees = np.degrees(angle)
-            
-            return angle_degrees
+            # Keep the interior angle in [0, 180]
+            return angle if angle <= 180 else 360 - angle
             
         except Exception as e:
             return 180  # Return neutral angle if calculation fails
@@ -77,28 +239,37 @@ class PoseAnalyzer:
         """
         try:
             # Get key landmarks for squat analysis
+            lh, lk, la = landmarks[_LHIP], landmarks[_LKNEE], landmarks[_LANKLE]
+            rh, rk, ra = landmarks[_RHIP], landmarks[_RKNEE], landmarks[_RANKLE]
+            
+            # Skip analysis when the legs are occluded or out of frame, so
+            # low-confidence landmarks can't produce false reps
+            if min(lh.visibility, lk.visibility, la.visibility,
+                   rh.visibility, rk.visibility, ra.visibility) < MIN_LANDMARK_VISIBILITY:
+                return {
+                    'count': self.squat_count,
+                    'stage': self.squat_stage,
+                    'angle': round(self.last_angle, 1),
+                    'feedback': "Step fully into view",
+                    'accuracy': min(100, max(0, self.accuracy_score))
+                }
+            
             # Left leg landmarks
-            left_hip = [landmarks[self.mp_pose.PoseLandmark.LEFT_HIP.value].x,
-                       landmarks[self.mp_pose.PoseLandmark.LEFT_HIP.value].y]
-            left_knee = [landmarks[self.mp_pose.PoseLandmark.LEFT_KNEE.value].x,
-                        landmarks[self.mp_pose.PoseLandmark.LEFT_KNEE.value].y]
-            left_ankle = [landmarks[self.mp_pose.PoseLandmark.LEFT_ANKLE.value].x,
-                         landmarks[self.mp_pose.PoseLandmark.LEFT_ANKLE.value].y]
+            left_hip = (lh.x, lh.y)
+            left_knee = (lk.x, lk.y)
+            left_ankle = (la.x, la.y)
             
             # Right leg landmarks
-            right_hip = [landmarks[self.mp_pose.PoseLandmark.RIGHT_HIP.value].x,
-                        landmarks[self.mp_pose.PoseLandmark.RIGHT_HIP.value].y]
-            right_knee = [landmarks[self.mp_pose.PoseLandmark.RIGHT_KNEE.value].x,
-                         landmarks[self.mp_pose.PoseLandmark.RIGHT_KNEE.value].y]
-            right_ankle = [landmarks[self.mp_pose.PoseLandmark.RIGHT_ANKLE.value].x,
-                          landmarks[self.mp_pose.PoseLandmark.RIGHT_ANKLE.value].y]
+            right_hip = (rh.x, rh.y)
+            right_knee = (rk.x, rk.y)
+            right_ankle = (ra.x, ra.y)
             
             # Calculate knee angles
             left_knee_angle = self.calculate_angle(left_hip, left_knee, left_ankle)
             right_knee_angle = self.calculate_angle(right_hip, right_knee, right_ankle)
             
-            # Use average of both knees for more stable detection
-            avg_knee_angle = (left_knee_angle + right_knee_angle) / 2
+            # Use smoothed average of both knees for more stable detection
+            avg_knee_angle = self._euro((left_knee_angle + right_knee_angle) / 2, t=time.monotonic())
             self.last_angle = avg_knee_angle
             
             # Squat detection logic with hysteresis to prevent flickering
@@ -163,46 +334,46 @@ class PoseAnalyzer:
                 scale = 640 / width
                 new_width = int(width * scale)
                 new_height = int(height * scale)
-                frame = cv2.resize(frame, (new_width, new_height))
+                if self._resize_buf is None or self._resize_buf.shape != (new_height, new_width, 3):
+                    self._resize_buf = np.empty((new_height, new_width, 3), np.uint8)
+                frame = cv2.resize(frame, (new_width, new_height), dst=self._resize_buf,
+                                   interpolation=cv2.INTER_AREA)
             
-            # Convert BGR to RGB
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            # Convert BGR to RGB for MediaPipe; the model only reads this copy,
+            # so mark it read-only and draw the overlay on the BGR frame instead
+            if self._rgb_buf is None or self._rgb_buf.shape != frame.shape:
+                self._rgb_buf = np.empty(frame.shape, np.uint8)
+            rgb_frame = self._rgb_buf
+            rgb_frame.flags.writeable = True
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=rgb_frame)
+            rgb_frame.flags.writeable = False
             
             # Process the frame
-            results = self.pose.process(rgb_frame)
+            pose_landmarks = self.find_pose(rgb_frame)
             
-            # Convert back to BGR for display
-            output_frame = cv2.cvtColor(rgb_frame, cv2.COLOR_RGB2BGR)
+            output_frame = frame
             
             pose_data = {
                 'landmarks_detected': False,
                 'squat_data': None
             }
             
-            if results.pose_landmarks:
+            if pose_landmarks is not None:
                 pose_data['landmarks_detected'] = True
                 
                 # Draw pose landmarks with optimized settings
                 self.mp_drawing.draw_landmarks(
                     output_frame, 
-                    results.pose_landmarks, 
+                    pose_landmarks, 
                     self.mp_pose.POSE_CONNECTIONS,
-                    self.mp_drawing.DrawingSpec(color=(0, 255, 0), thickness=2, circle_radius=2),
-                    self.mp_drawing.DrawingSpec(color=(0, 0, 255), thickness=2)
+                    self._landmark_spec,
+                    self._conn_spec
                 )
                 
                 # Analyze squats if in squat mode
                 if activity_mode == "Squat Counter":
-                    squat_data = self.detect_squat(results.pose_landmarks.landmark)
-                    pose_data['squat_data'] = squat_data
-                    
-                    # Add text overlay with squat info
-                    cv2.putText(output_frame, f"Reps: {squat_data['count']}", 
-                               (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-                    cv2.putText(output_frame, f"Stage: {squat_data['stage'].upper()}", 
-                               (10, 70), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 0, 0), 2)
-                    cv2.putText(output_frame, f"Angle: {squat_data['angle']}°", 
-                               (10, 110), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
+                    squat_data = self.detect_squat(pose_landmarks.landmark)
+                    pose_data['squat_data'] = squat_data  # Shown in the Streamlit sidebar
             
             return output_frame, pose_data
             
@@ -217,6 +388,13 @@ class PoseAnalyzer:
         self.accuracy_score = 0
         self.feedback_message = "Ready to start!"
     
+    def reset(self):
+        """Reset all per-session state, keeping the pose model loaded"""
+        self.reset_counter()
+        self.last_angle = 180
+        self.frame_skip_counter = 0
+        self._euro.reset()
+    
     def save_workout_data(self, reps, accuracy):
         """
         Save workout data to CSV file
@@ -235,17 +413,108 @@ class PoseAnalyzer:
             
             df = pd.DataFrame(workout_data)
             
-            # Try to append to existing file, create new if doesn't exist
-            try:
-                existing_df = pd.read_csv('workout_history.csv')
-                combined_df = pd.concat([existing_df, df], ignore_index=True)
-                combined_df.to_csv('workout_history.csv', index=False)
-            except FileNotFoundError:
-                df.to_csv('workout_history.csv', index=False)
+            # Append the new row; only write the header when creating the file
+            df.to_csv(WORKOUT_HISTORY_CSV, mode='a', index=False,
+                      header=not os.path.exists(WORKOUT_HISTORY_CSV))
                 
         except Exception as e:
             print(f"Error saving workout data: {e}")
 
+def load_workout_history(path=WORKOUT_HISTORY_CSV, cache_path=WORKOUT_HISTORY_CACHE):
+    """
+    Load workout history, reusing a pickled DataFrame while the CSV is unchanged
+    
+    Args:
+        path: Workout history CSV file
+        cache_path: Pickle cache refreshed whenever the CSV is newer
+        
+    Returns:
+        DataFrame with the workout history
+    """
+    if (os.path.exists(cache_path) and
+            os.path.getmtime(cache_path) >= os.path.getmtime(path)):
+        try:
+            return pd.read_pickle(cache_path)
+        except Exception:
+            pass  # Corrupt or incompatible cache, reparse the CSV
+    
+    df = pd.read_csv(path)
+    try:
+        df.to_pickle(cache_path)
+    except Exception as e:
+        print(f"Error caching workout history: {e}")
+    return df
+
+class _SpeechCharTable(dict):
+    """str.translate table keeping alphanumerics and whitespace, filled lazily"""
+    
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        self[codepoint] = codepoint if char.isalnum() or char.isspace() else None
+        return self[codepoint]
+
+_SPEECH_CHARS = _SpeechCharTable()
+
+def clean_speech_text(text):
+    """
+    Strip emoji and punctuation from feedback before it is spoken
+    
+    Args:
+        text: Feedback message
+        
+    Returns:
+        str: Text containing only alphanumerics and whitespace
+    """
+    return text.translate(_SPEECH_CHARS)
+
+def put_latest(q, item):
+    """
+    Put an item on a bounded queue, dropping the oldest entry if it is full
+    
+    Works with both queue.Queue and asyncio.Queue (call the latter from its
+    event loop). Used for feedback queues where only the newest message is
+    worth acting on.
+    """
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except (queue.Full, asyncio.QueueFull):
+            try:
+                q.get_nowait()
+            except (queue.Empty, asyncio.QueueEmpty):
+                pass
+
+async def text_to_speech_worker(feedback_queue):
+    """Speak feedback lines from an asyncio queue as they arrive"""
+    engine = None
+    while True:
+        feedback = await feedback_queue.get()
+        if not feedback:
+            continue
+        try:
+            if engine is None:
+                engine = pyttsx3.init()
+                engine.setProperty('rate', 150)
+                engine.setProperty('volume', 0.8)
+            engine.say(clean_speech_text(feedback))
+            engine.runAndWait()  # Blocks only the dedicated speech loop
+        except Exception as e:
+            print(f"TTS failed: {e}")
+
+def start_tts_loop():
+    """
+    Run the speech worker on its own asyncio loop in a daemon thread
+    
+    Returns:
+        callable: Thread-safe function that queues a feedback line to speak
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    feedback_queue = asyncio.Queue(maxsize=1)  # latest feedback wins
+    asyncio.run_coroutine_threadsafe(text_to_speech_worker(feedback_queue), loop)
+    return lambda feedback: loop.call_soon_threadsafe(put_latest, feedback_queue, feedback)
+
 def get_pose_landmarks_info():
     """
     Return information about MediaPipe pose landmarks